@@ -24,7 +24,10 @@
 # the discretion of STRG.AT GmbH also the competent court, in whose district the
 # Licensee has his registered seat, an establishment or assets.
 
-from ._init import init, ConfiguredVarnishModule, PurgeError
-from ._conf import add_route_caching as cache
+from ._init import (
+    init, ConfiguredVarnishModule, PurgeError, PurgeResult, PurgeSummary)
+from ._conf import add_route_caching as cache, esi_include
+from ._discovery import ServerSource
 
-__all__ = ('init', 'ConfiguredVarnishModule', 'PurgeError', 'cache')
+__all__ = ('init', 'ConfiguredVarnishModule', 'PurgeError', 'PurgeResult',
+           'PurgeSummary', 'ServerSource', 'cache', 'esi_include')
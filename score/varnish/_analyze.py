@@ -0,0 +1,433 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from collections import OrderedDict, deque
+from datetime import datetime
+import re
+import urllib.parse
+
+#: Upper bounds (in seconds) of the buckets used for collecting the age of
+#: cached objects. These are also the candidate values for TTL suggestions.
+interval_buckets = (
+    1, 5, 10, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 21600, 43200,
+    86400)
+
+#: The values of ``%{Varnish:handling}x`` (or ``%{Varnish:hitmiss}x``) we
+#: understand.
+handlings = ('hit', 'miss', 'pass', 'pipe', 'synth')
+
+#: HTTP methods that are considered invalidation requests.
+purge_methods = ('PURGE', 'BAN')
+
+line_regex = re.compile(
+    r'^\S+ \S+ \S+ \[(?P<time>[^\]]+)\] '
+    r'"(?P<method>[A-Z]+) (?P<url>\S+)[^"]*" (?P<status>\d{3}|-) ')
+
+quoted_regex = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+
+def _bucket(histogram, coverage):
+    total = sum(histogram)
+    if not total:
+        return None
+    seen = 0
+    for index, bound in enumerate(interval_buckets):
+        seen += histogram[index]
+        if seen >= coverage * total:
+            return bound
+    return interval_buckets[-1]
+
+
+def _add(histogram, seconds):
+    for index, bound in enumerate(interval_buckets):
+        if seconds <= bound:
+            histogram[index] += 1
+            return
+    histogram[-1] += 1
+
+
+def _histogram_dict(histogram):
+    return OrderedDict(
+        (str(bound), count) for bound, count in zip(
+            interval_buckets + ('inf',), histogram))
+
+
+def _format_interval(seconds):
+    if seconds is None:
+        return '-'
+    for unit, multiplier in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= multiplier and not seconds % multiplier:
+            return '%d%s' % (seconds // multiplier, unit)
+    return '%ds' % seconds
+
+
+class GroupStats:
+    """
+    Aggregated statistics of all requests belonging to a group of URLs, which
+    is either a :term:`route` or a path prefix. The *duration* is the caching
+    duration currently configured via :func:`score.varnish.cache`, if known.
+
+    The histograms :attr:`ages` and :attr:`validity` count values per bucket
+    of :data:`interval_buckets`. The former collects the time since the last
+    fetch of the object for every cacheable request, the latter the same
+    value for misses caused by a purge, i.e. how long the content stayed
+    valid.
+    """
+
+    def __init__(self, name, duration=None):
+        self.name = name
+        self.duration = duration
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+        self.passes = 0
+        self.others = 0
+        self.refetches = 0
+        self.purge_misses = 0
+        self.first = None
+        self.last = None
+        self.ages = [0] * (len(interval_buckets) + 1)
+        self.validity = [0] * (len(interval_buckets) + 1)
+
+    @property
+    def hit_ratio(self):
+        """
+        Ratio of hits among all cacheable (i.e. hit or missed) requests.
+        """
+        cacheable = self.hits + self.misses
+        if not cacheable:
+            return None
+        return self.hits / cacheable
+
+    @property
+    def rate(self):
+        """
+        Average number of requests per second.
+        """
+        if self.first is None or self.last <= self.first:
+            return None
+        return self.requests / (self.last - self.first)
+
+    @property
+    def churn(self):
+        """
+        Ratio of misses that fetched an object which had been requested
+        before, i.e. objects that expired, were evicted or purged in between.
+        """
+        if not self.misses:
+            return None
+        return self.refetches / self.misses
+
+    def suggest_ttl(self, coverage):
+        """
+        Returns a caching duration from :data:`interval_buckets` or `None`, if
+        there is not enough data.
+
+        The suggestion is the smallest bucket covering the given ratio of
+        :attr:`ages`, i.e. the time since the requested object was last fetched
+        from the backend. A request is a hit if this age is below the TTL, so
+        this is the duration that would have turned the given ratio of
+        requests into hits.
+
+        The current *duration* is never lowered, unless objects are usually
+        purged before it expires anyway (see :attr:`validity`).
+        """
+        suggestion = _bucket(self.ages, coverage)
+        if suggestion is None:
+            return None
+        if self.duration is not None and suggestion < self.duration:
+            validity = _bucket(self.validity, coverage)
+            if validity is None or validity >= self.duration:
+                return self.duration
+            return max(suggestion, validity)
+        return suggestion
+
+    def as_dict(self, coverage):
+        return {
+            'name': self.name,
+            'requests': self.requests,
+            'hits': self.hits,
+            'misses': self.misses,
+            'passes': self.passes,
+            'others': self.others,
+            'refetches': self.refetches,
+            'purge_misses': self.purge_misses,
+            'hit_ratio': self.hit_ratio,
+            'rate': self.rate,
+            'churn': self.churn,
+            'ages': _histogram_dict(self.ages),
+            'validity': _histogram_dict(self.validity),
+            'current_ttl': self.duration,
+            'suggested_ttl': self.suggest_ttl(coverage),
+        }
+
+
+class LogAnalyzer:
+    """
+    Computes caching statistics from varnishncsa_ log lines. The log must be
+    written with a format that ends in ``%{Varnish:handling}x``. The
+    :term:`purge requests <purge request>` sent by this module can only be
+    detected, if the purge path header is logged as the third quoted field
+    after the request, for example::
+
+        varnishncsa -F '%h %l %u %t "%r" %s %b "%{Referer}i" \\
+            "%{User-agent}i" "%{X-Purge-Path}i" %{Varnish:handling}x'
+
+    Requests with the HTTP method ``PURGE`` or ``BAN`` are always considered
+    purges of their exact URL. A miss is attributed to a purge, if one of the
+    last *max_purges* purges matched the URL after the object was fetched.
+
+    Requests are grouped by the first matching entry of *routes*, which is a
+    list of 3-tuples containing a name, a compiled regular expression for the
+    path and the configured caching duration (or `None`). Requests not
+    matching any route are grouped by the longest matching entry in
+    *prefixes*, falling back to the first *depth* segments of their path. At
+    most *max_groups* such prefix groups are created, all further requests
+    are collected in a group called ``other``.
+
+    Objects are identified by their URL and, if the logged request line
+    contains it (as varnishncsa's ``%r`` does), their host. The analyzer
+    remembers the last fetch of at most *max_objects* objects. Together with
+    the limits on groups and purges, this keeps the memory consumption
+    constant regardless of the size of the analyzed logs.
+
+    .. _varnishncsa: https://varnish-cache.org/docs/trunk/reference/varnishncsa.html
+    """
+
+    def __init__(self, *, routes=[], prefixes=[], depth=1, max_objects=100000,
+                 max_purges=1000, max_groups=100, coverage=0.9):
+        self.routes = list(routes)
+        self.prefixes = sorted(prefixes, key=len, reverse=True)
+        self.depth = depth
+        self.max_objects = max_objects
+        self.max_groups = max_groups
+        self._prefix_groups = 0
+        self.coverage = coverage
+        self.groups = OrderedDict()
+        for name, regex, duration in self.routes:
+            self.groups[name] = GroupStats(name, duration)
+        self.lines = 0
+        self.unparsed = 0
+        self.purges = 0
+        self.first = None
+        self.last = None
+        self._objects = OrderedDict()
+        self._purge_log = deque(maxlen=max_purges)
+        self._last_timestr = None
+        self._last_time = None
+
+    def feed_file(self, file):
+        """
+        Feeds all lines of given binary *file*. The file is consumed line by
+        line, so it is safe to pass log files of arbitrary size.
+        """
+        for line in file:
+            self.feed(line.decode('latin-1'))
+
+    def feed(self, line):
+        """
+        Processes a single log line.
+        """
+        self.lines += 1
+        match = line_regex.match(line)
+        if not match:
+            self.unparsed += 1
+            return
+        now = self._parse_time(match.group('time'))
+        if now is None:
+            self.unparsed += 1
+            return
+        if self.first is None or now < self.first:
+            self.first = now
+        if self.last is None or now > self.last:
+            self.last = now
+        url = match.group('url')
+        host = ''
+        if '://' in url:
+            start = url.index('://') + 3
+            slash = url.find('/', start)
+            if slash < 0:
+                host, url = url[start:], '/'
+            else:
+                host, url = url[start:slash], url[slash:]
+        purge = self._purge_regex(match, line, url)
+        if purge is not None:
+            self.purges += 1
+            if purge:
+                self._purge_log.append((self.lines, purge))
+            return
+        handling = line.rsplit(None, 1)[-1].lower()
+        if handling not in handlings:
+            handling = None
+        # varnish distinguishes objects by host and url
+        key = host + url
+        entry = self._objects.pop(key, None)
+        if entry is None:
+            path = urllib.parse.unquote(url.split('?', 1)[0])
+            group = self._group(path)
+            fetched, since = None, self.lines
+        else:
+            fetched, since, group = entry
+        group.requests += 1
+        if group.first is None or now < group.first:
+            group.first = now
+        if group.last is None or now > group.last:
+            group.last = now
+        if handling == 'hit':
+            group.hits += 1
+        elif handling == 'miss':
+            group.misses += 1
+        elif handling in ('pass', 'pipe'):
+            group.passes += 1
+        else:
+            group.others += 1
+        age = None
+        if fetched is not None and now >= fetched:
+            age = now - fetched
+            if handling in ('hit', 'miss'):
+                _add(group.ages, age)
+        if entry is not None and handling == 'miss':
+            group.refetches += 1
+            if self._purged(url, since) and (
+                    age is None or group.duration is None or
+                    age < group.duration):
+                group.purge_misses += 1
+                if age is not None:
+                    _add(group.validity, age)
+        if handling == 'miss':
+            fetched, since = now, self.lines
+        self._objects[key] = (fetched, since, group)
+        if len(self._objects) > self.max_objects:
+            self._objects.popitem(last=False)
+
+    def as_dict(self):
+        """
+        Returns the analysis result as a JSON-serializable `dict`.
+        """
+        return {
+            'lines': self.lines,
+            'unparsed': self.unparsed,
+            'purges': self.purges,
+            'start': self.first,
+            'end': self.last,
+            'coverage': self.coverage,
+            'groups': list(group.as_dict(self.coverage)
+                           for group in self.groups.values()
+                           if group.requests),
+        }
+
+    def report(self):
+        """
+        Returns the analysis result as a human readable table.
+        """
+        header = ('GROUP', 'REQS', 'REQ/S', 'HIT%', 'CHURN%', 'PURGED',
+                  'TTL', 'SUGGESTED')
+        rows = []
+        for group in self.groups.values():
+            if not group.requests:
+                continue
+            rows.append((
+                group.name,
+                str(group.requests),
+                '-' if group.rate is None else '%.2f' % group.rate,
+                '-' if group.hit_ratio is None else
+                '%.1f' % (group.hit_ratio * 100),
+                '-' if group.churn is None else '%.1f' % (group.churn * 100),
+                str(group.purge_misses),
+                _format_interval(group.duration),
+                _format_interval(group.suggest_ttl(self.coverage)),
+            ))
+        widths = list(map(len, header))
+        for row in rows:
+            widths = list(max(w, len(c)) for w, c in zip(widths, row))
+        lines = []
+        for row in [header] + rows:
+            cells = [row[0].ljust(widths[0])]
+            cells += list(c.rjust(w) for c, w in zip(row[1:], widths[1:]))
+            lines.append('  '.join(cells))
+        lines.append('')
+        lines.append('%d lines, %d unparsed, %d purge requests' % (
+            self.lines, self.unparsed, self.purges))
+        return '\n'.join(lines)
+
+    def _purge_regex(self, match, line, url):
+        # returns None if the line is not a purge request, the compiled
+        # regular expression of the purged URLs otherwise (or False, if the
+        # expression is not understood by python).
+        if match.group('method') in purge_methods:
+            return re.compile('^' + re.escape(url) + '$')
+        # the quoted fields following the request are the referer, the
+        # user agent and the optional purge path header.
+        fields = quoted_regex.findall(line, match.end())
+        if len(fields) < 3 or fields[2] in ('', '-'):
+            return None
+        try:
+            return re.compile(fields[2].replace('\\"', '"'))
+        except re.error:
+            return False
+
+    def _purged(self, url, since):
+        # checks whether a purge matching the url was logged after given
+        # line number. Varnish matches the purge path anywhere in the url.
+        for line, regex in reversed(self._purge_log):
+            if line <= since:
+                return False
+            if regex.search(url):
+                return True
+        return False
+
+    def _parse_time(self, timestr):
+        # consecutive log lines usually share the same timestamp, so we can
+        # avoid the rather slow strptime() call most of the time.
+        if timestr != self._last_timestr:
+            try:
+                time = datetime.strptime(timestr, '%d/%b/%Y:%H:%M:%S %z')
+            except ValueError:
+                return None
+            self._last_timestr = timestr
+            self._last_time = time.timestamp()
+        return self._last_time
+
+    def _group(self, path):
+        for name, regex, duration in self.routes:
+            if regex.match(path):
+                return self.groups[name]
+        for prefix in self.prefixes:
+            if path.startswith(prefix):
+                name = prefix
+                break
+        else:
+            segments = path.split('/')[1:self.depth + 1]
+            name = '/' + '/'.join(segments)
+        if name not in self.groups:
+            if self._prefix_groups >= self.max_groups:
+                name = 'other'
+                if name in self.groups:
+                    return self.groups[name]
+            else:
+                self._prefix_groups += 1
+            self.groups[name] = GroupStats(name)
+        return self.groups[name]
@@ -24,23 +24,47 @@
 # the discretion of STRG.AT GmbH also the competent court, in whose district the
 # Licensee has his registered seat, an establishment or assets.
 
+from collections import OrderedDict
 from score.init import parse_time_interval
 import functools
+import html
+import re
+import urllib.parse
 
+#: The header marking a response as containing ESI tags. The Varnish
+#: configuration is expected to enable ESI processing for such responses.
+esi_header = ('Surrogate-Control', 'content="ESI/1.0"')
 
-def add_route_caching(duration):
+
+def add_route_caching(duration, *, vary=None, etag=False):
     """
     Adds caching to a :term:`route` by adding the `Cache-Control` header
     `s-maxage` to the response. The header is only added to responses of ``GET``
     requests. The *duration* may be anything acceptable by
     :func:`score.init.parse_time_interval`.
 
+    All `Cache-Control` headers of the response are merged into a single one.
+    An existing ``s-maxage`` is replaced, and none is added at all if the
+    response was marked ``no-store`` or (without field names) ``private`` or
+    ``no-cache``. Likewise, all `Vary` headers are merged into one. If *vary*
+    is given, it must be a list of header names and all other values are
+    removed from the `Vary` header, which keeps the number of cached variants
+    per URL under control. A ``Vary: *`` is always kept and, since such a
+    response cannot be reused, prevents adding ``s-maxage``, too.
+
+    If *etag* is true, the response receives a strong `ETag` (unless it
+    already has one) and conditional ``GET`` requests are answered with
+    ``304 Not Modified``, which saves Varnish the transfer of the body when
+    revalidating an expired object.
+
     See `Section 14.9.3 of RFC 2616`__ for the documentation of the ``s-maxage``
     value.
 
     __ https://www.w3.org/Protocols/rfc2616/rfc2616-sec14.html#sec14.9.3
     """
     duration = parse_time_interval(duration)
+    if vary is not None:
+        vary = set(name.lower() for name in vary)
 
     def add_caching(route):
         callback = route.callback
@@ -48,12 +72,143 @@ def add_route_caching(duration):
         @functools.wraps(callback)
         def wrapper(ctx, *args, **kwargs):
             result = callback(ctx, *args, **kwargs)
-            if ctx.http.request.method == 'GET':
-                header = ('Cache-Control', 's-maxage=%d' % duration)
-                ctx.http.response.headerlist.append(header)
+            if ctx.http.request.method != 'GET':
+                return result
+            if etag:
+                result = _render(ctx, result)
+            if _is_response(result):
+                response = result
+            else:
+                response = ctx.http.response
+            headerlist = response.headerlist
+            headerlist[:] = _merge_vary(headerlist, vary)
+            headerlist[:] = _merge_cache_control(headerlist, duration)
+            if etag and response.status_code == 200:
+                if not response.etag:
+                    response.md5_etag()
+                response.conditional_response = True
             return result
 
+        # remember the duration for `score varnish analyze`
+        wrapper.score_varnish_cache = duration
         route.callback = wrapper
         return route
 
     return add_caching
+
+
+_cache_control_regex = re.compile(
+    r'([^\s,=]+)(?:\s*=\s*("[^"]*"|[^\s,]*))?')
+
+
+def _is_response(result):
+    return hasattr(result, 'headerlist')
+
+
+def _render(ctx, result):
+    # the same conversion score.http performs on the return value of a route,
+    # performed early to gain access to the response body.
+    if _is_response(result):
+        return result
+    response = ctx.http.response
+    if isinstance(result, str):
+        response.text = result
+    elif ctx.http.route.tpl:
+        if result is None:
+            result = {}
+        result['ctx'] = ctx
+        response.text = ctx.http.route.conf.tpl.render(
+            ctx.http.route.tpl, result)
+    return response
+
+
+def _merge_cache_control(headerlist, duration):
+    directives = OrderedDict()
+    for name, value in headerlist:
+        if name.lower() == 'cache-control':
+            for key, arg in _cache_control_regex.findall(value):
+                directives[key.lower()] = arg
+    if _is_shared_cacheable(headerlist, directives):
+        directives['s-maxage'] = '%d' % duration
+    value = ', '.join('%s=%s' % (key, arg) if arg else key
+                      for key, arg in directives.items())
+    return _replace_header(headerlist, 'Cache-Control', value)
+
+
+def _is_shared_cacheable(headerlist, directives):
+    # the field-qualified forms private="..." and no-cache="..." only apply
+    # to the listed headers, the response itself may still be cached.
+    if 'no-store' in directives:
+        return False
+    for key in ('private', 'no-cache'):
+        if key in directives and not directives[key]:
+            return False
+    for name, value in headerlist:
+        if name.lower() == 'vary' and value.strip() == '*':
+            return False
+    return True
+
+
+def _merge_vary(headerlist, whitelist):
+    names = OrderedDict()
+    for name, value in headerlist:
+        if name.lower() == 'vary':
+            for header in value.split(','):
+                header = header.strip()
+                if header:
+                    names.setdefault(header.lower(), header)
+    if whitelist is not None:
+        names = OrderedDict((key, header) for key, header in names.items()
+                            if key in whitelist or key == '*')
+    if '*' in names:
+        value = '*'
+    else:
+        value = ', '.join(names.values())
+    return _replace_header(headerlist, 'Vary', value)
+
+
+def _replace_header(headerlist, name, value):
+    """
+    Replaces all occurrences of the header *name* with a single header at the
+    position of the first occurrence. The header is removed if *value* is
+    empty.
+    """
+    result = []
+    for header in headerlist:
+        if header[0].lower() != name.lower():
+            result.append(header)
+        elif value:
+            result.append((name, value))
+            value = None
+    if value:
+        result.append((name, value))
+    return result
+
+
+def esi_include(ctx, route, *args, **kwargs):
+    """
+    Returns an ``<esi:include>`` tag for the URL of given :term:`route`, which
+    is generated via :mod:`score.http` using the remaining arguments. The
+    included route is a separate object in Varnish and may thus have its own
+    caching duration (see :func:`cache`) and can be purged
+    independently of the pages including it.
+
+    This function also adds the header ``Surrogate-Control:
+    content="ESI/1.0"`` to the current response, which tells Varnish to
+    process the ESI tags of this page.
+
+    The returned string is marked as safe markup (i.e. it has an ``__html__``
+    method), so it is not escaped when rendered in an auto-escaping template.
+    """
+    url = urllib.parse.urlsplit(ctx.http.url(route, *args, **kwargs))
+    src = urllib.parse.urlunsplit(('', '', url.path or '/', url.query, ''))
+    ctx.http.response.headers[esi_header[0]] = esi_header[1]
+    return _Markup('<esi:include src="%s"/>' % html.escape(src))
+
+
+class _Markup(str):
+    # the protocol of markupsafe, which prevents escaping in jinja2 and other
+    # template engines.
+
+    def __html__(self):
+        return str(self)
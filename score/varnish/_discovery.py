@@ -0,0 +1,245 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+import logging
+import os
+import socket
+import threading
+import time
+from score.init import parse_host_port, ConfigurationError
+
+log = logging.getLogger('score.varnish')
+
+
+def parse_server_source(value, ttl):
+    """
+    Creates a :class:`ServerSource` for a single entry of the :confkey:`servers`
+    configuration. The *ttl* is used whenever the source itself does not
+    provide a better value.
+    """
+    if value.startswith('dns:'):
+        host, port = parse_host_port(value[4:])
+        return DnsSource(host, port, ttl)
+    if value.startswith('srv:'):
+        try:
+            import dns.resolver  # noqa
+        except ImportError:
+            raise ConfigurationError(
+                'score.varnish',
+                'Discovering servers via SRV records requires dnspython, '
+                'install score.varnish[dns]')
+        return SrvSource(value[4:], ttl)
+    if value.startswith('file:'):
+        return FileSource(value[5:], ttl)
+    return StaticSource([parse_host_port(value)])
+
+
+def _resolve(name, rdtype):
+    import dns.resolver
+    # dnspython 2.0 renamed query() to resolve(), which no longer applies the
+    # search domains by default.
+    if hasattr(dns.resolver, 'resolve'):
+        return dns.resolver.resolve(name, rdtype, search=True)
+    return dns.resolver.query(name, rdtype)
+
+
+def _addresses(host, port):
+    # the addresses are always looked up by the system resolver, which also
+    # honors /etc/hosts, search domains and IPv6.
+    addresses = []
+    for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+        if info[4][0] not in addresses:
+            addresses.append(info[4][0])
+    return addresses
+
+
+def _address_ttl(host, fallback):
+    # the system resolver does not expose the TTL of the records, so we ask
+    # dnspython for it, if it is installed.
+    try:
+        import dns.exception
+    except ImportError:
+        return fallback
+    ttls = []
+    for rdtype in ('A', 'AAAA'):
+        try:
+            ttls.append(_resolve(host, rdtype).rrset.ttl)
+        except dns.exception.DNSException:
+            pass
+    if not ttls:
+        return fallback
+    return min(ttls)
+
+
+class ServerSource:
+    """
+    Base class for providers of Varnish_ servers. Subclasses implement
+    ``_fetch()``, which returns a list of ``(host, port)`` tuples and the
+    number of seconds this list may be cached.
+
+    If fetching fails, the error is logged and stored in :attr:`error`, and
+    the previously known servers (if any) are used until the next attempt,
+    which takes place after *ttl* seconds.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.error = None
+        self._servers = ()
+        self._expires = None
+        self._lock = threading.Lock()
+
+    @property
+    def servers(self):
+        if self._expires is not None and time.monotonic() < self._expires:
+            return self._servers
+        with self._lock:
+            # another thread might have refreshed in the meantime
+            if self._expires is None or time.monotonic() >= self._expires:
+                self._refresh()
+        return self._servers
+
+    def refresh(self):
+        """
+        Fetches the servers immediately, regardless of the cache state. This
+        method never raises an exception, see :attr:`error` instead.
+        """
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        # must be called while holding the lock
+        try:
+            servers, ttl = self._fetch()
+        except Exception as e:
+            log.exception(e)
+            self.error = e.with_traceback(None)
+            ttl = self.ttl
+        else:
+            self.error = None
+            self._servers = tuple(servers)
+        self._expires = time.monotonic() + ttl
+
+    def _fetch(self):
+        raise NotImplementedError()
+
+
+class StaticSource(ServerSource):
+    """
+    Provides a fixed list of servers.
+    """
+
+    def __init__(self, servers):
+        super().__init__(None)
+        self._servers = tuple(servers)
+        self._expires = float('inf')
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self._servers))
+
+    def _fetch(self):
+        return self._servers, float('inf')
+
+
+class DnsSource(ServerSource):
+    """
+    Provides all addresses of *host* as returned by :func:`socket.getaddrinfo`.
+    If dnspython_ is installed, the addresses are cached for the TTL of the
+    host's A and AAAA records, otherwise for *ttl* seconds.
+
+    .. _dnspython: http://www.dnspython.org/
+    """
+
+    def __init__(self, host, port, ttl):
+        super().__init__(ttl)
+        self.host = host
+        self.port = port
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.host, self.port)
+
+    def _fetch(self):
+        servers = [(address, self.port)
+                   for address in _addresses(self.host, self.port)]
+        return servers, _address_ttl(self.host, self.ttl)
+
+
+class SrvSource(ServerSource):
+    """
+    Provides the addresses of the targets of the SRV records of *name*,
+    cached for the lowest TTL of the involved records. Requires dnspython_.
+    """
+
+    def __init__(self, name, ttl):
+        super().__init__(ttl)
+        self.name = name
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.name)
+
+    def _fetch(self):
+        answer = _resolve(self.name, 'SRV')
+        ttl = answer.rrset.ttl
+        records = sorted(answer, key=lambda r: (r.priority, -r.weight))
+        servers = []
+        # resolving the targets here spares every purge request the lookup
+        for record in records:
+            target = record.target.to_text(omit_final_dot=True)
+            ttl = min(ttl, _address_ttl(target, ttl))
+            for address in _addresses(target, record.port):
+                server = (address, record.port)
+                if server not in servers:
+                    servers.append(server)
+        return servers, ttl
+
+
+class FileSource(ServerSource):
+    """
+    Provides the servers listed in the file at *path*, one ``host:port`` per
+    line. Empty lines and lines starting with ``#`` are ignored. The file is
+    checked for modifications every *ttl* seconds.
+    """
+
+    def __init__(self, path, ttl):
+        super().__init__(ttl)
+        self.path = path
+        self._mtime = None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.path)
+
+    def _fetch(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self._mtime:
+            return self._servers, self.ttl
+        servers = []
+        with open(self.path) as file:
+            for line in file:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    servers.append(parse_host_port(line))
+        self._mtime = mtime
+        return servers, self.ttl
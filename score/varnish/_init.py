@@ -24,15 +24,18 @@
 # the discretion of STRG.AT GmbH also the competent court, in whose district the
 # Licensee has his registered seat, an establishment or assets.
 
+import collections
 import threading
+import time
 from http.client import HTTPConnection
 from score.init import (
-    ConfiguredModule, parse_time_interval, parse_list, parse_host_port,
-    extract_conf)
+    ConfiguredModule, parse_time_interval, parse_list, extract_conf)
+from ._discovery import ServerSource, StaticSource, parse_server_source
 
 defaults = {
     'timeout': '5s',
     'servers': [],
+    'discovery.ttl': '30s',
     'header.domain': 'X-Purge-Domain',
     'header.path': 'X-Purge-Path',
     'header.type': 'X-Purge-Type',
@@ -46,7 +49,24 @@ def init(confdict):
 
     :confkey:`servers` :confdefault:`[]`
         A :func:`list <score.init.parse_list>` of Varnish hosts interpreted via
-        :func:`score.init.parse_host_port`.
+        :func:`score.init.parse_host_port`. Instead of a host, an entry may
+        also describe a source for discovering hosts at runtime:
+
+        - ``dns:varnish.example.com:6081`` uses all addresses of the given host
+          name,
+        - ``srv:_varnish._tcp.example.com`` uses the targets of the SRV
+          records of the given name (requires dnspython_, which is installed
+          with ``score.varnish[dns]``) and
+        - ``file:/etc/varnish-hosts`` reads the hosts from given file, one
+          ``host:port`` per line.
+
+        .. _dnspython: http://www.dnspython.org/
+
+    :confkey:`discovery.ttl` :confdefault:`30s`
+        The :func:`duration <score.init.parse_time_interval>` for caching the
+        hosts of discovery sources. Host names are always resolved by the
+        system resolver, but their addresses are cached for the TTL of their
+        DNS records instead, if dnspython_ is installed.
 
     :confkey:`timeout` :confdefault:`5s`
         The :func:`timeout <score.init.parse_time_interval>` for sending
@@ -63,7 +83,9 @@ def init(confdict):
     """
     conf = dict(defaults.items())
     conf.update(confdict)
-    servers = [parse_host_port(host) for host in parse_list(conf['servers'])]
+    ttl = parse_time_interval(conf['discovery.ttl'])
+    servers = [parse_server_source(value, ttl)
+               for value in parse_list(conf['servers'])]
     timeout = parse_time_interval(conf['timeout'])
     header_mapping = extract_conf(conf, 'header.')
     return ConfiguredVarnishModule(servers, timeout, header_mapping)
@@ -72,6 +94,8 @@ def init(confdict):
 class ConfiguredVarnishModule(ConfiguredModule):
     """
     This module's :class:`configuration object <score.init.ConfiguredModule>`.
+    The *servers* may contain ``(host, port)`` tuples as well as
+    :class:`ServerSource` objects.
     """
 
     def __init__(self, servers, timeout, header_mapping):
@@ -81,8 +105,43 @@ class ConfiguredVarnishModule(ConfiguredModule):
         self.timeout = timeout
         self.header_mapping = header_mapping
 
+    @property
+    def servers(self):
+        """
+        The list of ``(host, port)`` tuples of all currently known Varnish_
+        hosts. Discovered hosts are refreshed transparently once their cache
+        duration expires.
+        """
+        servers = []
+        for source in self.sources:
+            for server in source.servers:
+                if server not in servers:
+                    servers.append(server)
+        return servers
+
+    @servers.setter
+    def servers(self, servers):
+        static = []
+        sources = []
+        for server in servers:
+            if isinstance(server, ServerSource):
+                sources.append(server)
+            else:
+                static.append(server)
+        if static:
+            sources.insert(0, StaticSource(static))
+        # replacing the whole tuple keeps concurrent readers consistent
+        self.sources = tuple(sources)
+
+    def refresh_servers(self):
+        """
+        Discovers all Varnish_ hosts anew, ignoring any cached results.
+        """
+        for source in self.sources:
+            source.refresh()
+
     def purge(self, *, domains=[], domain=None, paths=[], path=None, type=None,
-              raise_on_error=True):
+              raise_on_error=True, callback=None):
         """
         Sends multiple :term:`purge requests <purge request>` to all configured
         Varnish servers with given keyword arguments for domains and paths.
@@ -92,8 +151,15 @@ class ConfiguredVarnishModule(ConfiguredModule):
         The keyword argument *type* sends the :term:`type <purge type>` of purge
         request to perform.
 
+        Returns a list of :class:`PurgeResult` objects, one for each request in
+        the order the requests were created, followed by one failed result for
+        every :class:`ServerSource` that could not discover its servers. If a
+        *callback* is given, each result is passed to it in the same order as
+        soon as it is available, and the returned list is empty.
+
         This method raises a :class:`PurgeError` containing a list of
-        :class:`.PurgeError` causes if one of the requests fails for any reason.
+        :class:`.PurgeError` causes if one of the requests fails for any reason
+        and *raise_on_error* is true.
 
         You can pass a *domain* and/or a *path*, ...
 
@@ -132,43 +198,130 @@ class ConfiguredVarnishModule(ConfiguredModule):
 
             varnish_conf.purge()
         """
+        results = []
+        exceptions = []
+
+        def collect(result):
+            if result.error:
+                exceptions.append(result.error)
+            if callback:
+                callback(result)
+            else:
+                results.append(result)
+
+        self._purge(collect, domains, domain, paths, path, type)
+        if raise_on_error and exceptions:
+            raise PurgeError('One or more Exceptions occured.', exceptions)
+        return results
+
+    def purge_summary(self, *, domains=[], domain=None, paths=[], path=None,
+                      type=None, raise_on_error=True):
+        """
+        Sends the same :term:`purge requests <purge request>` as :meth:`purge`,
+        but returns a :class:`PurgeSummary` instead of a :class:`PurgeResult`
+        for every request. Use this if you are only interested in the number
+        of successful and failed requests, as the results of the individual
+        requests are discarded as soon as they are counted.
+
+        If *raise_on_error* is true, a :class:`PurgeError` without causes is
+        raised if any of the requests failed.
+        """
+        summary = PurgeSummary()
+        self._purge(summary.add, domains, domain, paths, path, type)
+        if raise_on_error and summary.failed:
+            raise PurgeError('%d of %d purge requests failed.' % (
+                summary.failed, summary.total))
+        return summary
+
+    def purge_route(self, route, **kwargs):
+        """
+        Purges all URLs of given :mod:`score.http` :term:`route`. This is
+        particularly useful for invalidating :func:`ESI fragments
+        <score.varnish.esi_include>` without touching the pages including
+        them. All keyword arguments are passed to :meth:`purge`.
+
+        .. code-block:: python
+
+            varnish_conf.purge_route(http_conf.route('weather-widget'))
+
+        Varnish matches the purge path against the URL as requested, i.e.
+        percent-encoded and including the query string. The URLs of the route
+        are therefore purged regardless of their query string, but variables
+        of the route containing characters that need encoding may not match.
+        """
+        pattern = route.urltpl.regex.pattern
+        if not pattern.startswith('^'):
+            pattern = '^' + pattern
+        if pattern.endswith('$') and not pattern.endswith('\\$'):
+            pattern = pattern[:-1]
+        pattern += r'(\?.*)?$'
+        return self.purge(path=pattern, **kwargs)
+
+    def _purge(self, callback, domains, domain, paths, path, type):
         if domains and domain:
             raise ValueError('Both *domain* and *domains* given')
         if paths and path:
             raise ValueError('Both *path* and *paths* given')
-        if not self.servers:
+        # purges operate on a snapshot of the servers, so hosts appearing or
+        # disappearing during a purge do not affect it.
+        servers = self.servers
+        failed = list(source for source in self.sources if source.error)
+        if not servers and not failed:
             # we could return even earlier than this, but even if there are no
             # servers configured, the checks of the keyword arguments should be
             # performed nonetheless.  otherwise we would start getting
             # unexpected errors as soon as varnish was enabled.
-            return []
+            return
         # copy values to avoid tainting the function defaults
-        domains = domains[:]
-        paths = paths[:]
+        domains = list(domains)
+        paths = list(paths)
         if domain:
             domains.append(domain)
         if path:
             paths.append(path)
-        requests = []
-        for server in self.servers:
+        requests = collections.deque()
+        for server in servers:
             for domain in domains or [None]:
                 for path in paths or [None]:
                     request = PurgeRequest(self, server, domain, path, type)
                     request.start()
                     requests.append(request)
-        for request in requests:
+        # results are passed on in request order and each request is dropped
+        # as soon as its result was handed to the callback.
+        while requests:
+            request = requests.popleft()
             request.join()
-        if raise_on_error:
-            exceptions = list(r.exception for r in requests if r.exception)
-            if exceptions:
-                raise PurgeError('One or more Exceptions occured.', exceptions)
-        return requests
+            callback(request.result)
+        # sources that could not provide their servers count as failed
+        # requests, as we cannot know which servers we have missed.
+        for source in failed:
+            for domain in domains or [None]:
+                for path in paths or [None]:
+                    callback(PurgeResult(
+                        source, domain, path, type, None, 0.0, source.error))
+
+
+def _purge_repr(obj):
+    parts = ['server=%r']
+    args = [obj.__class__.__name__, obj.server]
+    if obj.path is not None:
+        parts.append('path=%r')
+        args.append(obj.path)
+    if obj.domain is not None:
+        parts.append('domain=%r')
+        args.append(obj.domain)
+    if obj.type is not None:
+        parts.append('type=%r')
+        args.append(obj.type)
+    tpl = '%s(' + ', '.join(parts) + ')'
+    return tpl % tuple(args)
 
 
 class PurgeRequest(threading.Thread):
     """
     A PurgeRequest handles a HTTP request with the method *PURGE* to a
-    Varnish_ server.
+    Varnish_ server. The outcome is stored as a :class:`PurgeResult` in
+    :attr:`result`.
     """
 
     def __init__(self, conf, server, domain, path, type):
@@ -178,35 +331,29 @@ class PurgeRequest(threading.Thread):
         self.domain = domain
         self.path = path
         self.type = type
-        self.exception = None
-        self.response = None
+        self.status = None
+        self.result = None
 
-    def __repr__(self):
-        parts = ['server=%r']
-        args = [self.__class__.__name__, self.server]
-        if self.path is not None:
-            parts.append('path=%r')
-            args.append(self.path)
-        if self.domain is not None:
-            parts.append('domain=%r')
-            args.append(self.domain)
-        if self.type is not None:
-            parts.append('type=%r')
-            args.append(self.type)
-        tpl = '%s(' + ', '.join(parts) + ')'
-        return tpl % tuple(args)
+    __repr__ = _purge_repr
 
     def run(self):
+        error = None
+        start = time.perf_counter()
         try:
             self.send()
         except Exception as e:
             self.conf.log.exception(e)
-            self.exception = e
+            # the traceback would keep all frames of this thread alive
+            error = e.with_traceback(None)
+        latency = time.perf_counter() - start
+        self.result = PurgeResult(
+            self.server, self.domain, self.path, self.type, self.status,
+            latency, error)
 
     def send(self):
         """
-        Sends the request to the provided :attr:`server`. Returns a
-        :class:`PurgeResponse` or raises a :class:`PurgeError`.
+        Sends the request to the provided :attr:`server`. Raises a
+        :class:`PurgeError` if the server did not respond with status 200.
         """
         self.conf.log.info(self)
         headers = dict()
@@ -220,12 +367,82 @@ class PurgeRequest(threading.Thread):
         try:
             connection.request('GET', '/', headers=headers)
             response = connection.getresponse()
+            self.status = response.status
+            reason = response.reason
         finally:
             connection.close()
-        self.response = response
-        self.conf.log.info(response)
-        if response.status is not 200:
-            raise PurgeError(response.reason)
+        self.conf.log.info('%d %s' % (self.status, reason))
+        if self.status != 200:
+            raise PurgeError(reason)
+
+
+class PurgeResult:
+    """
+    The outcome of a single :term:`purge request`. The *server* is a ``(host,
+    port)`` tuple, or the :class:`ServerSource` that failed to discover its
+    servers. The *status* is the HTTP status code returned by the server (or
+    `None`, if the request could not be sent), the *latency* is the duration
+    of the request in seconds and the *error* is the exception that occurred,
+    if any. Exceptions are stored without their traceback.
+    """
+
+    __slots__ = ('server', 'domain', 'path', 'type', 'status', 'latency',
+                 'error')
+
+    def __init__(self, server, domain, path, type, status, latency, error):
+        self.server = server
+        self.domain = domain
+        self.path = path
+        self.type = type
+        self.status = status
+        self.latency = latency
+        self.error = error
+
+    __repr__ = _purge_repr
+
+    @property
+    def success(self):
+        return self.error is None
+
+
+class PurgeSummary:
+    """
+    Aggregated outcome of multiple :term:`purge requests <purge request>`
+    containing the number of *total*, *succeeded* and *failed* requests as
+    well as the *max_latency* and the *total_latency* in seconds.
+    """
+
+    __slots__ = ('total', 'succeeded', 'failed', 'total_latency',
+                 'max_latency')
+
+    def __init__(self):
+        self.total = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def __repr__(self):
+        return '%s(total=%d, succeeded=%d, failed=%d)' % (
+            self.__class__.__name__, self.total, self.succeeded, self.failed)
+
+    @property
+    def mean_latency(self):
+        if not self.total:
+            return None
+        return self.total_latency / self.total
+
+    def add(self, result):
+        """
+        Counts given :class:`PurgeResult`.
+        """
+        self.total += 1
+        if result.success:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        self.total_latency += result.latency
+        self.max_latency = max(self.max_latency, result.latency)
 
 
 class PurgeError(Exception):
@@ -25,7 +25,9 @@
 # Licensee has his registered seat, an establishment or assets.
 
 import click
-import traceback
+import json
+import sys
+from ._analyze import LogAnalyzer
 
 
 @click.group()
@@ -60,19 +62,62 @@ def purge(click_ctx, domains, paths, type_, timeout, confirm):
         if type_:
             prompt = 'Purge %s?' % (type_,)
         click.confirm(prompt, abort=True)
-    requests = varnish.purge(domains=domains, paths=paths, type=type_,
-                             raise_on_error=False)
-    for request in requests:
-        print('%r - ' % (request,), end='')
-        if request.response and request.response.status != 200:
+
+    def print_result(result):
+        print('%r - ' % (result,), end='')
+        if result.success:
+            print('SUCCESS')
+        elif result.status is not None:
             print('ERROR')
-            print('  %d - %s' % (request.response.status,
-                                 request.response.reason))
-        elif request.exception:
+            print('  %d - %s' % (result.status, result.error))
+        else:
             print('ERROR')
-            traceback.print_exception(
-                type(request.exception),
-                request.exception,
-                request.exception.__traceback__)
+            print('  %s: %s' % (type(result.error).__name__, result.error))
+
+    # results are printed as they arrive instead of being collected first
+    varnish.purge(domains=domains, paths=paths, type=type_,
+                  raise_on_error=False, callback=print_result)
+
+
+@main.command('analyze')
+@click.argument('logfiles', nargs=-1, type=click.File('rb'))
+@click.option('-p', '--prefix', 'prefixes', multiple=True,
+              help='A path prefix to group requests by.')
+@click.option('--depth', 'depth', type=int, default=1,
+              help='Number of path segments to group unmatched requests by.')
+@click.option('--coverage', 'coverage', type=float, default=0.9,
+              help='Ratio of reuse intervals a suggested TTL must cover.')
+@click.option('--max-objects', 'max_objects', type=int, default=100000,
+              help='Maximum number of URLs to keep track of.')
+@click.option('--max-groups', 'max_groups', type=int, default=100,
+              help='Maximum number of path prefix groups.')
+@click.option('--max-purges', 'max_purges', type=int, default=1000,
+              help='Maximum number of purges to match misses against.')
+@click.option('--routes/--no-routes', 'use_routes', default=True,
+              help='Group requests by the routes of score.http.')
+@click.option('--json', 'json_file', type=click.File('w'), default=None,
+              help='Write the result as JSON to given file.')
+@click.pass_context
+def analyze(click_ctx, logfiles, prefixes, depth, coverage, max_objects,
+            max_groups, max_purges, use_routes, json_file):
+    """
+    Analyzes varnishncsa logs and suggests caching durations.
+    """
+    routes = []
+    if use_routes:
+        try:
+            http = click_ctx.obj['conf'].load('http')
+        except Exception as e:
+            click.echo('Not grouping by routes: %s' % (e,), err=True)
         else:
-            print('SUCCESS')
+            for name, route in http.routes.items():
+                duration = getattr(route.callback, 'score_varnish_cache', None)
+                routes.append((name, route.urltpl.regex, duration))
+    analyzer = LogAnalyzer(routes=routes, prefixes=prefixes, depth=depth,
+                           max_objects=max_objects, max_purges=max_purges,
+                           max_groups=max_groups, coverage=coverage)
+    for file in logfiles or [sys.stdin.buffer]:
+        analyzer.feed_file(file)
+    print(analyzer.report())
+    if json_file:
+        json.dump(analyzer.as_dict(), json_file, indent=2)
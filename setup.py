@@ -67,4 +67,7 @@ setup(
     install_requires=[
         'score.init >= 0.3',
     ],
+    extras_require={
+        'dns': ['dnspython'],
+    },
 )